@@ -53,15 +53,26 @@ import re
 
 
 TYPES = {'github': {'token': None}}
-S3_REGEX = r'^s3:\/\/([a-zA-Z0-9\_\-]+)\/?([a-zA-Z0-9\_\/\.]+)?'
+S3_REGEX = r'^s3:\/\/([a-zA-Z0-9\_\-\.]+)\/?(.+)?'
+
+
+def parse_s3(location):
+    '''
+    Return (bucket, key) of an s3://bucket/key location, or None if the
+    location isn't in S3. The key is None if not set.
+    '''
+    s3_info = re.search(S3_REGEX, location)
+    if not s3_info:
+        return None
+    return s3_info.group(1), (s3_info.group(2) or '').strip('/') or None
+
 
 def load(conf):
     '''Attempts to load the config after checking for S3 or local'''
-    s3_info = re.search(S3_REGEX, conf)
+    s3_info = parse_s3(conf)
 
     if s3_info:
-        bucket = s3_info.group(1)
-        key = s3_info.group(2)
+        bucket, key = s3_info
         return load_s3(bucket, key)
 
     return load_file(conf)
@@ -102,7 +113,8 @@ class Configuration(object):
 
         # Populate self.artifacts
         for artifact in self._raw.get('artifacts', []):
-            art_obj = {'name': artifact['name'], 'sources': OrderedDict()}
+            art_obj = artifact.copy()
+            art_obj['sources'] = OrderedDict()
 
             for repo in artifact.get('sources', []):
                 r_info = self._raw['sources'].get(repo['name'])
@@ -1,23 +1,45 @@
 '''Main functionality for artifact creation'''
 
 import copy
+import io
 import os
 import logging
+import queue
 import random
-import re
 import shutil
 import string
+import tarfile
 import tempfile
+import threading
+import time
 import zipfile
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-from multiplexer.source import Github
+from multiplexer import report
+from multiplexer.config import parse_s3
+from multiplexer.multipart import MultipartUploadWriter, parse_destination
+from multiplexer.pgzip import ParallelGzipFile
+from multiplexer.source import Github, S3Cache
+from multiplexer.trace import Trace
 
 import boto3
 import yaml
 
+from boto3.s3.transfer import TransferConfig
+
 LOG = logging.getLogger(__name__)
-S3_REGEX = r'^s3:\/\/([a-zA-Z0-9\_\-]+)\/?([a-zA-Z0-9\_\/]+)?'
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 10
+PIPELINE_DEPTH = 1
+PIPELINE_POLL = 0.1
+
+# Package formats and their extensions, matching CodeDeploy bundle types
+FORMATS = OrderedDict([('zip', '.zip'), ('tar', '.tar'), ('tgz', '.tgz')])
+CONTENT_TYPES = {'zip': 'application/zip',
+                 'tar': 'application/x-tar',
+                 'tgz': 'application/gzip'}
 
 
 def random_string(length):
@@ -25,19 +47,105 @@ def random_string(length):
         string.ascii_letters + string.digits) for _ in range(length))
 
 
+def package_name(name, package_format):
+    """Return the file name of a package in the given format"""
+    ext = FORMATS.get(package_format)
+    if not ext:
+        raise ValueError('invalid package format ' + package_format)
+    if name.endswith(ext):
+        return name
+    return name + ext
+
+
+def pipelined(iterable, depth):
+    """
+    Iterate over iterable in a background thread, running at most
+    depth items ahead of the consumer. Exceptions raised by iterable
+    are raised to the consumer.
+
+    Closing the generator, e.g. when the consumer fails, stops the
+    background thread once its current item is done and waits for it.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=PIPELINE_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as err:
+            _put((None, err))
+            return
+        _put((done, None))
+
+    producer = threading.Thread(target=_produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item, err = items.get()
+            if err:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
 class Package(object):
-    """Handles packaging the resulting artifact"""
-    def __init__(self, name, root):
-        if re.search(r'.zip$', name):
-            self.name = name
-        else:
-            self.name = name + '.zip'
+    """
+    Handles packaging the resulting artifact
+
+    zip packages are staged in a temporary workspace and zipped by
+    create(), tar and tgz packages are streamed straight into the
+    package as files are added. If fileobj is given every format is
+    streamed into it rather than a file under root.
+    """
+    def __init__(self, name, root, package_format='zip', fileobj=None):
+        self.name = package_name(name, package_format)
+        self.format = package_format
         self.root = path.abspath(root)
         self.package_path = path.join(self.root, self.name)
-
-        tmp_dir_name = '.aws_cd_multiplex-' + random_string(10)
-        self._tmp_workspace = path.join(self.root, tmp_dir_name)
-        os.makedirs(self._tmp_workspace)
+        self._tmp_workspace = None
+        self._tar = None
+        self._zip = None
+        self._fileobj = fileobj
+        self._streamed = fileobj is not None
+
+        if self._fileobj and self.format == 'zip':
+            self._zip = zipfile.ZipFile(self._fileobj, 'w',
+                                        zipfile.ZIP_DEFLATED)
+            return
+
+        if not self._fileobj:
+            pkg_dir = path.dirname(self.package_path)
+            if not path.isdir(pkg_dir):
+                os.makedirs(pkg_dir)
+
+        if self.format == 'zip':
+            tmp_dir_name = '.aws_cd_multiplex-' + random_string(10)
+            self._tmp_workspace = path.join(self.root, tmp_dir_name)
+            os.makedirs(self._tmp_workspace)
+            return
+
+        self._fileobj = self._fileobj or open(self.package_path, 'wb')
+        if self.format == 'tgz':
+            self._fileobj = ParallelGzipFile(self._fileobj)
+        self._tar = tarfile.open(fileobj=self._fileobj, mode='w|')
 
     def add_file(self, name, source=None, body=None):
         """
@@ -53,11 +161,29 @@ class Package(object):
         body -- Body of new file to write into package.
                 Mutually exclusive with source arg.
         """
-
-        dest = path.join(self._tmp_workspace, name)
         if not source and not body:
             raise TypeError('must set either source or body')
 
+        if self._tar:
+            if source:
+                self._tar.add(source, arcname=name)
+            if body:
+                data = body.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = time.time()
+                self._tar.addfile(info, io.BytesIO(data))
+            return
+
+        if self._zip:
+            if source:
+                self._zip.write(source, name)
+            if body:
+                self._zip.writestr(name, body)
+            return
+
+        dest = path.join(self._tmp_workspace, name)
         if source:
             shutil.copyfile(source, dest)
         if body:
@@ -73,6 +199,29 @@ class Package(object):
         Arguments:
         source -- path to source directory
         """
+        if self._tar:
+            if source:
+                self._tar.add(source, arcname=name)
+            else:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = time.time()
+                self._tar.addfile(info)
+            return
+
+        if self._zip:
+            if not source:
+                self._zip.writestr(name.rstrip('/') + '/', '')
+                return
+            for root, _, files in os.walk(source):
+                for filename in files:
+                    absname = path.join(root, filename)
+                    arcname = path.join(name, path.relpath(absname, source))
+                    LOG.debug('Zipping %s as %s' % (absname, arcname))
+                    self._zip.write(absname, arcname)
+            return
+
         dest = path.join(self._tmp_workspace, name)
         if source:
             shutil.copytree(source, dest)
@@ -81,10 +230,22 @@ class Package(object):
 
     def create(self):
         """
-        Create the package zipfile
+        Create the package file
 
         Returns Full Path to package
         """
+        if self._zip:
+            self._zip.close()
+            self._fileobj.close()
+            LOG.info("Zipfile %s streamed" % self.name)
+            return self.package_path
+
+        if self._tar:
+            self._tar.close()
+            self._fileobj.close()
+            LOG.info("Tarfile %s created" % self.package_path)
+            return self.package_path
+
         zf = zipfile.ZipFile(self.package_path, 'w', zipfile.ZIP_DEFLATED)
         abs_src = self._tmp_workspace
         for root, _, files in os.walk(self._tmp_workspace):
@@ -98,9 +259,49 @@ class Package(object):
         LOG.info("Zipfile %s created" % self.package_path)
         return self.package_path
 
+    def entries(self):
+        """
+        Return (name, compressed bytes, uncompressed bytes) of each file
+        in a streamed package once created.
+        """
+        if self._zip:
+            return [(info.filename, info.compress_size, info.file_size)
+                    for info in self._zip.infolist()
+                    if not info.filename.endswith('/')]
+        if self._tar:
+            return [(info.name, info.size, info.size)
+                    for info in self._tar.members if info.isfile()]
+        raise Exception('entries only available for streamed packages')
+
+    def abort(self):
+        """
+        Discard a package that failed part way without finishing it.
+        A streamed package's file object is left to its owner, a tar
+        package written under root is removed.
+        """
+        if self._zip:
+            # ZipFile writes its central directory on close, or when
+            # collected, unless its file handle is gone
+            self._zip.fp = None
+            self._zip = None
+
+        if self._tar:
+            # Likewise for the end of archive blocks of the tar stream
+            self._tar.closed = True
+            self._tar.fileobj.closed = True
+            self._tar = None
+            raw = self._fileobj
+            if isinstance(self._fileobj, ParallelGzipFile):
+                raw = self._fileobj.fileobj
+                self._fileobj.abort()
+            if not self._streamed:
+                raw.close()
+                os.remove(self.package_path)
+
     def clean_tmp(self):
         """clean up tmp"""
-        shutil.rmtree(self._tmp_workspace)
+        if self._tmp_workspace:
+            shutil.rmtree(self._tmp_workspace)
 
 
 class AppSpec(object):
@@ -183,11 +384,29 @@ class AppSpec(object):
         return yaml.dump(obj, default_flow_style=False)
 
 
-def upload_to_s3(source, destination):
-    """Given a source file, upload it to S3"""
-    s3_info = re.search(S3_REGEX, destination)
-    bucket = s3_info.group(1)
-    key = s3_info.group(2)
+def bundle_type(source):
+    """Return the CodeDeploy bundle type of a package file"""
+    for package_format, ext in FORMATS.items():
+        if source.endswith(ext):
+            return package_format
+    raise ValueError('unknown bundle type for ' + source)
+
+
+def upload_to_s3(source, destination, part_size=UPLOAD_PART_SIZE,
+                 concurrency=UPLOAD_CONCURRENCY, package_format=None,
+                 metadata=None):
+    """
+    Given a source file, upload it to S3
+
+    Keyword arguments:
+    part_size -- Size in bytes of each part of a multipart upload.
+    concurrency -- Number of parts to upload in parallel.
+    package_format -- CodeDeploy bundle type stored in the object
+                      metadata, taken from the file extension if not set.
+    metadata -- Additional object metadata.
+    """
+    package_format = package_format or bundle_type(source)
+    bucket, key = parse_s3(destination)
 
     s3 = boto3.resource('s3')
     full_key = path.basename(source)
@@ -195,50 +414,233 @@ def upload_to_s3(source, destination):
         full_key = path.join(key, path.basename(source))
     LOG.info("Uploading %s to bucket %s as %s"
             % (source, bucket, full_key))
-    s3.meta.client.upload_file(source, bucket, full_key)
-
-
-def build_artifact(name, config, destination, clean=True):
-    """Given an artifact name and config build a complete artifact"""
-    workspace = tempfile.mkdtemp()
-    artifact = config.artifact(name)
-    pkg_destination = destination
-
-    # If using S3 then set temporary worspace as destination
-    store_s3 = re.search(S3_REGEX, destination)
-    LOG.debug("Package destination %s is S3" % destination)
-    if store_s3:
-        pkg_destination = workspace
+    transfer_config = TransferConfig(multipart_threshold=part_size,
+                                     multipart_chunksize=part_size,
+                                     max_concurrency=concurrency)
+    obj_metadata = {'bundle-type': package_format}
+    obj_metadata.update(metadata or {})
+    extra_args = {'ContentType': CONTENT_TYPES[package_format],
+                  'Metadata': obj_metadata}
+    s3.meta.client.upload_file(source, bucket, full_key,
+                               ExtraArgs=extra_args, Config=transfer_config)
+
+
+def copy_to_local(source, destination, name=None):
+    """
+    Given a source file, copy it to a local directory
+
+    Keyword arguments:
+    name -- Path of the copy relative to destination, defaults to the
+            file name of source.
+    """
+    dest = path.join(destination, name or path.basename(source))
+    if not path.isdir(path.dirname(dest)):
+        os.makedirs(path.dirname(dest))
+    LOG.info("Copying %s to %s" % (source, dest))
+    shutil.copy(source, dest)
+
+
+def store_package(source, destinations, part_size=UPLOAD_PART_SIZE,
+                  concurrency=UPLOAD_CONCURRENCY, package_format=None,
+                  metadata=None, name=None):
+    """
+    Store a package in every destination concurrently.
+
+    Keyword arguments:
+    name -- Path of the package relative to local destinations, as
+            built by Package. Defaults to the file name of source.
+
+    Returns an OrderedDict of destination to the exception raised
+    while storing to it, or None if it succeeded.
+    """
+    def _store(destination):
+        if parse_s3(destination):
+            upload_to_s3(source, destination, part_size, concurrency,
+                         package_format, metadata)
+        else:
+            copy_to_local(source, destination, name)
+
+    results = OrderedDict()
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        futures = [(dest, executor.submit(_store, dest))
+                   for dest in destinations]
+        for destination, future in futures:
+            results[destination] = future.exception()
+            if results[destination]:
+                LOG.error("Storing %s in %s failed: %s"
+                        % (source, destination, results[destination]))
+            else:
+                LOG.info("Stored %s in %s" % (source, destination))
+    return results
 
-    pkg = Package(name, pkg_destination)
 
-    global_appspec = AppSpec('global')
+def fetch_sources(name, artifact, config, workspace, cache=None, trace=None):
+    """
+    Download and extract each source of an artifact into workspace,
+    yielding (source name, source info, extracted path) in order.
+    """
+    trace = trace or Trace()
     for src_name, src_info in artifact['sources'].items():
         LOG.info("Fetching source %s for %s" % (src_name, name))
         src = Github(config.github['token'], src_info['owner'],
-                     src_info['repository'], src_info['revision'])
-        src.download()
+                     src_info['repository'], src_info['revision'], cache)
+        with trace.span('fetch', artifact=name, source=src_name):
+            src.download()
         LOG.info("Source %s downloaded" % src_name)
-        pth = src.extract(workspace)
-        pkg.add_directory(src_info['repository'], source=pth)
-        src.clean()
-
-        # If source has an appspec file listed, then merge it to global
-        src_appspec_file = path.join(pth, 'appspec.yml')
-        if path.isfile(src_appspec_file):
-            src_appspec = AppSpec(src_info['repository'])
-
-            with open(src_appspec_file, 'r') as a_fil:
-                src_appspec.load(a_fil.read())
-            global_appspec = global_appspec.merge(src_appspec)
+        with trace.span('extract', artifact=name, source=src_name):
+            pth = src.extract(workspace)
+            src.clean()
+        yield src_name, src_info, pth
+
+
+def build_artifact(name, config, destination, clean=True,
+                   report_destination=None, size_budget=None,
+                   part_size=UPLOAD_PART_SIZE, concurrency=UPLOAD_CONCURRENCY,
+                   package_format=None, trace=None, source_cache=None,
+                   pipeline=False):
+    """
+    Given an artifact name and config build a complete artifact
+
+    Arguments:
+    destination -- Local directory or S3 location, or a list of them.
+
+    Keyword arguments:
+    clean -- Remove the temporary workspace once complete.
+    report_destination -- Local directory or S3 location to store the
+                          composition report in, the previous report found
+                          there is used for the diff. Defaults to the
+                          first destination.
+    size_budget -- Maximum package size in bytes, the build fails if exceeded.
+                   Defaults to the artifact's size_budget setting.
+    part_size -- Size in bytes of each part of S3 multipart uploads.
+    concurrency -- Number of parts uploaded in parallel per S3 destination.
+    package_format -- One of zip, tar or tgz. Defaults to the artifact's
+                      format setting, or zip.
+    trace -- Trace to record build spans against, its ID is stored in
+             the metadata of uploaded packages.
+    source_cache -- S3 location of the shared source archive cache.
+    pipeline -- Download the next source while the previous one is
+                packaged and stream the package into multipart uploads
+                as it is written. Only used if every destination is S3.
+
+    Returns an OrderedDict of destination to the exception raised while
+    storing to it, or None if it succeeded.
+    """
+    destinations = destination
+    if isinstance(destination, str):
+        destinations = [destination]
+    trace = trace or Trace()
+    cache = S3Cache(source_cache) if source_cache else None
 
-    pkg.add_file('appspec.yml', body=global_appspec.serialize())
-    final_pkg = pkg.create()
-
-    if store_s3:
-        upload_to_s3(final_pkg, destination)
+    workspace = tempfile.mkdtemp()
+    artifact = config.artifact(name)
+    pkg_destination = destinations[0]
+    package_format = package_format or artifact.get('format', 'zip')
+    report_destination = report_destination or destinations[0]
+    size_budget = size_budget or artifact.get('size_budget')
+
+    metadata = {}
+    if trace.trace_id:
+        metadata['trace-id'] = trace.trace_id
+
+    all_s3 = all(parse_s3(dest) for dest in destinations)
+    if pipeline and not all_s3:
+        LOG.info("Pipelined build requires S3 destinations, building staged")
+        pipeline = False
+
+    # If using S3, several destinations or a size budget then set
+    # temporary workspace as destination and store the package afterwards,
+    # so a package over budget never reaches its destination
+    store_copies = len(destinations) > 1 or all_s3 or bool(size_budget)
+    if store_copies:
+        LOG.debug("Package destinations %s" % ', '.join(destinations))
+        pkg_destination = workspace
 
-    if clean:
-        LOG.debug("removing workspace files: " + workspace)
-        pkg.clean_tmp()
-        shutil.rmtree(workspace)
+    sources = fetch_sources(name, artifact, config, workspace, cache, trace)
+    writer = None
+    if pipeline:
+        pkg_file = path.basename(package_name(name, package_format))
+        obj_metadata = {'bundle-type': package_format}
+        obj_metadata.update(metadata)
+        writer = MultipartUploadWriter(
+            [parse_destination(dest, pkg_file) for dest in destinations],
+            part_size, concurrency, CONTENT_TYPES[package_format],
+            obj_metadata)
+        sources = pipelined(sources, PIPELINE_DEPTH)
+
+    pkg = None
+    try:
+        try:
+            pkg = Package(name, pkg_destination, package_format, fileobj=writer)
+
+            global_appspec = AppSpec('global')
+            for src_name, src_info, pth in sources:
+                with trace.span('package', artifact=name, source=src_name):
+                    pkg.add_directory(src_info['repository'], source=pth)
+
+                # If source has an appspec file listed, then merge it to global
+                src_appspec_file = path.join(pth, 'appspec.yml')
+                if path.isfile(src_appspec_file):
+                    src_appspec = AppSpec(src_info['repository'])
+
+                    with open(src_appspec_file, 'r') as a_fil:
+                        src_appspec.load(a_fil.read())
+                    global_appspec = global_appspec.merge(src_appspec)
+
+            with trace.span('package', artifact=name):
+                pkg.add_file('appspec.yml', body=global_appspec.serialize())
+                final_pkg = pkg.create()
+
+            with trace.span('report', artifact=name):
+                # Only staged zips need reading back, streamed packages
+                # and tar packages list their own entries
+                if writer or package_format != 'zip':
+                    pkg_report = report.Report(
+                        name, final_pkg,
+                        package_bytes=writer.size if writer else None)
+                    for entry in pkg.entries():
+                        pkg_report.add(*entry)
+                else:
+                    pkg_report = report.Report.from_package(name, final_pkg)
+            pkg_report.check_budget(size_budget)
+
+            with trace.span('report', artifact=name):
+                report_name = report.report_name(name)
+                previous = report.load_previous(report_destination, report_name)
+                report_body = pkg_report.serialize(previous)
+        except Exception:
+            # Drop the package before its file object is closed
+            if pkg:
+                pkg.abort()
+            if writer:
+                writer.abort()
+            raise
+
+        results = OrderedDict([(destinations[0], None)])
+        if writer:
+            with trace.span('upload', artifact=name):
+                results = writer.complete()
+        elif store_copies:
+            with trace.span('upload', artifact=name):
+                results = store_package(final_pkg, destinations, part_size,
+                                        concurrency, package_format, metadata,
+                                        pkg.name)
+    finally:
+        # Stop fetching further sources before the workspace is removed
+        sources.close()
+        if clean:
+            LOG.debug("removing workspace files: " + workspace)
+            if pkg:
+                pkg.clean_tmp()
+            shutil.rmtree(workspace)
+
+    failed = [dest for dest, err in results.items() if err]
+    if failed:
+        raise Exception('artifact {} failed to store in {}'.format(
+            name, ', '.join(failed)))
+
+    # Only a stored build becomes the previous report of the next one
+    with trace.span('report', artifact=name):
+        report.store(report_destination, report_name, report_body)
+
+    return results
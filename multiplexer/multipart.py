@@ -0,0 +1,174 @@
+'''Streaming S3 multipart uploads'''
+
+import logging
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiplexer.config import parse_s3
+
+import boto3
+
+from botocore.config import Config
+
+LOG = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than this, other than the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUploadWriter(object):
+    """
+    Write only file object uploading everything written to it to one or
+    more S3 objects as multipart uploads. Each part is uploaded as soon
+    as it fills, at most concurrency parts are in flight per destination
+    and writes block until one completes.
+
+    Uploads are only completed by complete(), so a package can still
+    be discarded with abort() once fully written. part_size is raised
+    to MIN_PART_SIZE if smaller.
+    """
+    def __init__(self, destinations, part_size, concurrency,
+                 content_type=None, metadata=None):
+        if part_size < MIN_PART_SIZE:
+            LOG.warning("Part size %s is below the S3 minimum, using %s"
+                    % (part_size, MIN_PART_SIZE))
+            part_size = MIN_PART_SIZE
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.size = 0
+        self.closed = False
+        # Every destination gets its own share of workers and connections
+        self._max_pending = concurrency * max(len(destinations), 1)
+        self._client = boto3.client(
+            's3', config=Config(max_pool_connections=self._max_pending))
+        self._executor = ThreadPoolExecutor(max_workers=self._max_pending)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._part_number = 0
+
+        extra_args = {'Metadata': metadata or {}}
+        if content_type:
+            extra_args['ContentType'] = content_type
+
+        # Destination to upload state
+        self._uploads = OrderedDict()
+        for destination, bucket, key in destinations:
+            upload = {'bucket': bucket, 'key': key, 'parts': {},
+                      'id': None, 'error': None}
+            try:
+                resp = self._client.create_multipart_upload(
+                    Bucket=bucket, Key=key, **extra_args)
+                upload['id'] = resp['UploadId']
+            except Exception as err:
+                LOG.error("Starting upload to %s failed: %s"
+                        % (destination, err))
+                upload['error'] = err
+            self._uploads[destination] = upload
+
+    def _upload_part(self, upload, part_number, data):
+        if upload['error']:
+            return
+        try:
+            resp = self._client.upload_part(
+                Bucket=upload['bucket'], Key=upload['key'],
+                UploadId=upload['id'], PartNumber=part_number, Body=data)
+            upload['parts'][part_number] = resp['ETag']
+        except Exception as err:
+            upload['error'] = err
+
+    def _submit(self, data):
+        self._part_number += 1
+        for upload in self._uploads.values():
+            self._pending.append(self._executor.submit(
+                self._upload_part, upload, self._part_number, data))
+
+        # Bound memory by waiting for the oldest parts to finish
+        while len(self._pending) > self._max_pending:
+            self._pending.popleft().result()
+
+    def write(self, data):
+        """Buffer data and upload each full part"""
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.size += len(data)
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        """Parts are uploaded as they fill, nothing to flush"""
+        pass
+
+    def close(self):
+        """Upload the final part and wait for all parts to finish"""
+        if self.closed:
+            return
+        if self._buffer or not self._part_number:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._pending.popleft().result()
+        self._executor.shutdown()
+        self.closed = True
+
+    def complete(self):
+        """
+        Complete every upload.
+
+        Returns an OrderedDict of destination to the exception raised
+        while uploading to it, or None if it succeeded.
+        """
+        self.close()
+        results = OrderedDict()
+        for destination, upload in self._uploads.items():
+            if not upload['error']:
+                parts = [{'ETag': etag, 'PartNumber': num}
+                         for num, etag in sorted(upload['parts'].items())]
+                try:
+                    self._client.complete_multipart_upload(
+                        Bucket=upload['bucket'], Key=upload['key'],
+                        UploadId=upload['id'],
+                        MultipartUpload={'Parts': parts})
+                except Exception as err:
+                    upload['error'] = err
+
+            if upload['error']:
+                LOG.error("Upload to %s failed: %s"
+                        % (destination, upload['error']))
+                self._abort(upload)
+            else:
+                LOG.info("Uploaded %s bytes to %s" % (self.size, destination))
+            results[destination] = upload['error']
+        return results
+
+    def abort(self):
+        """Abort every upload"""
+        self.close()
+        for upload in self._uploads.values():
+            self._abort(upload)
+
+    def _abort(self, upload):
+        if not upload['id']:
+            return
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=upload['bucket'], Key=upload['key'],
+                UploadId=upload['id'])
+        except Exception as err:
+            LOG.warning("Aborting upload of %s failed: %s"
+                    % (upload['key'], err))
+
+
+def parse_destination(destination, name):
+    """Return (destination, bucket, key) of a package name in an S3 location"""
+    bucket, prefix = parse_s3(destination)
+    key = name
+    if prefix:
+        key = prefix + '/' + name
+    return destination, bucket, key
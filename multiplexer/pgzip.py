@@ -0,0 +1,123 @@
+'''Block parallel gzip compression'''
+
+import os
+import struct
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 128 * 1024
+DICT_SIZE = 32 * 1024
+COMPRESS_LEVEL = 6
+
+
+def _compress_block(block, zdict, level, last):
+    """
+    Compress a block as raw deflate data, primed with the tail of the
+    previous block. Blocks are ended with a sync flush so they can be
+    concatenated into a single deflate stream, the last block finishes it.
+    """
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zdict=zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = comp.compress(block)
+    if last:
+        return data + comp.flush(zlib.Z_FINISH)
+    return data + comp.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """
+    Write only file object producing gzip output, compressing blocks
+    in parallel across threads in the style of pigz. zlib releases the
+    GIL while compressing so blocks are compressed on all cores.
+
+    The output is a single gzip member readable by standard gzip.
+    """
+    def __init__(self, fileobj, level=COMPRESS_LEVEL, block_size=BLOCK_SIZE,
+                 workers=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._zdict = None
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+
+        self._write_header()
+
+    def _write_header(self):
+        # Magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00' +
+                           struct.pack('<L', int(time.time())) +
+                           b'\x00\xff')
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._executor.submit(
+            _compress_block, block, self._zdict, self.level, last))
+        self._zdict = block[-DICT_SIZE:] if block else self._zdict
+
+        # Bound memory by writing out finished blocks in order
+        while len(self._pending) > self.workers * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        """Buffer data and compress each full block"""
+        if self.closed:
+            raise ValueError('write to closed file')
+        data = bytes(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.extend(data)
+
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        """Blocks are written as they complete, nothing to flush"""
+        pass
+
+    def close(self):
+        """Compress remaining data and write the gzip trailer"""
+        if self.closed:
+            return
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+
+        self.fileobj.write(struct.pack('<LL', self._crc & 0xffffffff,
+                                       self._size & 0xffffffff))
+        self.fileobj.close()
+        self.closed = True
+
+    def abort(self):
+        """
+        Stop compressing without writing the rest of the stream, fileobj
+        is left open
+        """
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,243 @@
+'''Artifact composition and size reporting'''
+
+import json
+import logging
+import os
+import tarfile
+import zipfile
+
+from collections import OrderedDict
+from os import path
+from multiplexer.config import parse_s3
+
+import boto3
+
+LOG = logging.getLogger(__name__)
+ROOT_SOURCE = '<root>'
+TOP_ENTRIES = 10
+SIZE_KEYS = ('files', 'compressed_bytes', 'uncompressed_bytes')
+
+
+def _ratio(compressed, uncompressed):
+    """Return compressed / uncompressed, 1.0 for empty content"""
+    if not uncompressed:
+        return 1.0
+    return round(float(compressed) / uncompressed, 4)
+
+
+def _sizes():
+    return OrderedDict((key, 0) for key in SIZE_KEYS)
+
+
+def _add_sizes(totals, compressed, uncompressed):
+    totals['files'] += 1
+    totals['compressed_bytes'] += compressed
+    totals['uncompressed_bytes'] += uncompressed
+
+
+def _delta(current, previous):
+    """Return the difference of two size dicts"""
+    current = current or {}
+    previous = previous or {}
+    return OrderedDict(
+        (key, current.get(key, 0) - previous.get(key, 0)) for key in SIZE_KEYS)
+
+
+class Report(object):
+    """
+    Composition report of a packaged artifact.
+
+    Sizes are grouped by source (the top level directory of the
+    package), by directory and by file extension. The ratio reported
+    is compressed bytes / uncompressed bytes. Entries of tar based
+    packages aren't compressed individually, so only the package_bytes
+    total reflects tgz compression.
+    """
+    def __init__(self, name, package_path, top=TOP_ENTRIES,
+                 package_bytes=None):
+        self.name = name
+        self.package_path = package_path
+        self.top = top
+        self.entries = []
+        self._package_bytes = package_bytes
+
+    @classmethod
+    def from_zip(cls, name, package_path, top=TOP_ENTRIES):
+        """Build a report from the entries of a zip package"""
+        report = cls(name, package_path, top)
+        with zipfile.ZipFile(package_path, 'r') as zf:
+            for info in zf.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                report.add(info.filename, info.compress_size, info.file_size)
+        return report
+
+    @classmethod
+    def from_tar(cls, name, package_path, top=TOP_ENTRIES):
+        """Build a report from the entries of a tar or tgz package"""
+        report = cls(name, package_path, top)
+        with tarfile.open(package_path, 'r:*') as tf:
+            for info in tf:
+                if info.isfile():
+                    report.add(info.name, info.size, info.size)
+        return report
+
+    @classmethod
+    def from_package(cls, name, package_path, top=TOP_ENTRIES):
+        """Build a report from a zip, tar or tgz package"""
+        if zipfile.is_zipfile(package_path):
+            return cls.from_zip(name, package_path, top)
+        return cls.from_tar(name, package_path, top)
+
+    def package_bytes(self):
+        """Return the size of the package"""
+        if self._package_bytes is not None:
+            return self._package_bytes
+        return path.getsize(self.package_path)
+
+    def add(self, arcname, compressed, uncompressed):
+        """Record a single packaged file"""
+        self.entries.append((arcname, compressed, uncompressed))
+
+    def summary(self):
+        """Return the report as a dict"""
+        totals = _sizes()
+        sources = OrderedDict()
+        directories = {}
+        extensions = {}
+
+        for arcname, compressed, uncompressed in self.entries:
+            _add_sizes(totals, compressed, uncompressed)
+
+            parts = arcname.split('/')
+            source = parts[0] if len(parts) > 1 else ROOT_SOURCE
+            _add_sizes(sources.setdefault(source, _sizes()),
+                       compressed, uncompressed)
+
+            for idx in range(1, len(parts)):
+                dir_name = '/'.join(parts[:idx])
+                _add_sizes(directories.setdefault(dir_name, _sizes()),
+                           compressed, uncompressed)
+
+            ext = path.splitext(parts[-1])[1].lower() or '<none>'
+            _add_sizes(extensions.setdefault(ext, _sizes()),
+                       compressed, uncompressed)
+
+        totals['package_bytes'] = self.package_bytes()
+        totals['ratio'] = _ratio(totals['compressed_bytes'],
+                                 totals['uncompressed_bytes'])
+
+        largest_files = sorted(self.entries, key=lambda e: e[2], reverse=True)
+        largest_dirs = sorted(directories.items(),
+                              key=lambda d: d[1]['uncompressed_bytes'],
+                              reverse=True)
+
+        ext_summary = OrderedDict()
+        for ext, sizes in sorted(extensions.items(),
+                                 key=lambda e: e[1]['uncompressed_bytes'],
+                                 reverse=True):
+            sizes['ratio'] = _ratio(sizes['compressed_bytes'],
+                                    sizes['uncompressed_bytes'])
+            ext_summary[ext] = sizes
+
+        return OrderedDict([
+            ('artifact', self.name),
+            ('package', path.basename(self.package_path)),
+            ('totals', totals),
+            ('sources', sources),
+            ('largest_files', [
+                OrderedDict([('path', arcname),
+                             ('compressed_bytes', compressed),
+                             ('uncompressed_bytes', uncompressed)])
+                for arcname, compressed, uncompressed in largest_files[:self.top]]),
+            ('largest_directories', [
+                OrderedDict([('path', dir_name)] + list(sizes.items()))
+                for dir_name, sizes in largest_dirs[:self.top]]),
+            ('extensions', ext_summary),
+        ])
+
+    def diff(self, previous):
+        """
+        Return the difference between this report and the summary
+        of a previous build of the same artifact.
+        """
+        current = self.summary()
+        totals = _delta(current['totals'], previous.get('totals'))
+        totals['package_bytes'] = (current['totals']['package_bytes'] -
+                                   previous.get('totals', {}).get('package_bytes', 0))
+
+        res = OrderedDict([('totals', totals)])
+        for key in ('sources', 'extensions'):
+            prev_group = previous.get(key, {})
+            cur_group = current[key]
+            names = list(cur_group) + [n for n in prev_group if n not in cur_group]
+            res[key] = OrderedDict(
+                (name, _delta(cur_group.get(name), prev_group.get(name)))
+                for name in names)
+        return res
+
+    def serialize(self, previous=None):
+        """Return JSON string of the report, diffed against previous if set"""
+        obj = self.summary()
+        obj['diff'] = self.diff(previous) if previous else None
+        return json.dumps(obj, indent=2)
+
+    def check_budget(self, budget):
+        """Raise an exception if the package is larger than budget bytes"""
+        size = self.package_bytes()
+        if budget and size > budget:
+            raise Exception('artifact {} is {} bytes, exceeds size budget of {} bytes'.format(
+                self.name, size, budget))
+
+
+def report_name(artifact_name):
+    """
+    Return the report key of an artifact, artifact names may contain
+    slashes so e.g. production/allapps is stored as
+    production/allapps.report.json.
+    """
+    return artifact_name.strip('/') + '.report.json'
+
+
+def load_previous(destination, name):
+    """Load a previous report from a local directory or S3, None if missing"""
+    s3_info = parse_s3(destination)
+    if s3_info:
+        bucket, key = s3_info
+        key = path.join(key, name) if key else name
+        client = boto3.client('s3')
+        try:
+            resp = client.get_object(Bucket=bucket, Key=key)
+        except client.exceptions.NoSuchKey:
+            return None
+        body = resp['Body'].read()
+        if isinstance(body, (bytes, bytearray)):
+            body = body.decode('utf-8')
+        return json.loads(body)
+
+    pth = path.join(destination, name)
+    if not path.isfile(pth):
+        return None
+    with open(pth, 'r') as fil:
+        return json.load(fil)
+
+
+def store(destination, name, body):
+    """Write a report to a local directory or S3"""
+    s3_info = parse_s3(destination)
+    if s3_info:
+        bucket, key = s3_info
+        key = path.join(key, name) if key else name
+        LOG.info("Storing report in bucket %s as %s" % (bucket, key))
+        client = boto3.client('s3')
+        client.put_object(Bucket=bucket, Key=key,
+                          Body=body.encode('utf-8'),
+                          ContentType='application/json')
+        return
+
+    pth = path.join(destination, name)
+    if not path.isdir(path.dirname(pth)):
+        os.makedirs(path.dirname(pth))
+    LOG.info("Storing report %s" % pth)
+    with open(pth, 'w+') as fil:
+        fil.write(body)
@@ -4,7 +4,7 @@ import os
 import logging
 import multiplexer
 
-from multiplexer import config, merge, __version__
+from multiplexer import config, merge, trace, __version__
 
 
 def main(arv=None):
@@ -23,10 +23,34 @@ def main(arv=None):
                         required=True)
     parser.add_argument('--github-token', '-T', dest='github_token',
                         help='Token to use when pulling Github packages.')
-    parser.add_argument('--destination', '-d',
+    parser.add_argument('--destination', '-d', action='append',
             help='''Destination to store the artifacts (local or s3).
-                    Use s3://bucket/key for S3.''',
-                        default=os.getcwd())
+                    Use s3://bucket/key for S3. May be given several
+                    times to store the artifacts in each destination.''')
+    parser.add_argument('--report-destination', '-r', dest='report_destination',
+            help='''Destination to store artifact reports (local or s3), the
+                    previous report stored there is diffed against.
+                    Defaults to the artifact destination.''')
+    parser.add_argument('--size-budget', '-b', dest='size_budget', type=int,
+                        help='Fail the build if an artifact exceeds this many bytes.')
+    parser.add_argument('--part-size', dest='part_size', type=int,
+                        default=merge.UPLOAD_PART_SIZE // (1024 * 1024),
+                        help='Size in MB of each part of S3 multipart uploads.')
+    parser.add_argument('--upload-concurrency', dest='upload_concurrency',
+                        type=int, default=merge.UPLOAD_CONCURRENCY,
+                        help='Number of parts uploaded in parallel per S3 destination.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='''Download sources while packaging and stream packages
+                                into S3 multipart uploads as they are written.''')
+    parser.add_argument('--source-cache', dest='source_cache',
+                        default=os.getenv('MULTIPLEXER_SOURCE_CACHE'),
+                        help='''S3 location (s3://bucket/prefix) of the source archive
+                                cache shared between builds.''')
+    parser.add_argument('--trace-format', dest='trace_format',
+                        choices=trace.FORMATS,
+                        default=os.getenv(trace.ENV_FORMAT),
+                        help='''Write the push to artifact timeline to stdout
+                                in this format once all artifacts are built.''')
     parser.add_argument('artifacts', nargs='*')
 
     verbose = parser.add_mutually_exclusive_group()
@@ -39,6 +63,7 @@ def main(arv=None):
 
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel)
+    build_trace = trace.Trace.from_env()
 
     conf = config.load(args.config)
     if args.github_token:
@@ -48,5 +73,19 @@ def main(arv=None):
     if args.artifacts:
         artifacts = args.artifacts
 
-    for artifact in artifacts:
-        merge.build_artifact(artifact, conf, args.destination)
+    destinations = args.destination or [os.getcwd()]
+
+    try:
+        for artifact in artifacts:
+            with build_trace.span('artifact', artifact=artifact):
+                merge.build_artifact(artifact, conf, destinations,
+                                     report_destination=args.report_destination,
+                                     size_budget=args.size_budget,
+                                     part_size=args.part_size * 1024 * 1024,
+                                     concurrency=args.upload_concurrency,
+                                     trace=build_trace,
+                                     source_cache=args.source_cache,
+                                     pipeline=args.pipeline)
+    finally:
+        if args.trace_format:
+            build_trace.emit(args.trace_format)
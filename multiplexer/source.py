@@ -1,5 +1,6 @@
 '''Sources for artifact'''
 
+import logging
 import os
 import re
 import shutil
@@ -8,6 +9,57 @@ import urllib
 import zipfile
 import github
 
+import boto3
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from multiplexer.config import parse_s3
+
+LOG = logging.getLogger(__name__)
+EXTRACT_WORKERS = os.cpu_count() or 1
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class S3Cache(object):
+    """Source archive cache shared between builds in S3"""
+    def __init__(self, location):
+        s3_info = parse_s3(location)
+        if not s3_info:
+            raise ValueError('invalid source cache location ' + location)
+        self.bucket = s3_info[0]
+        self.prefix = s3_info[1] or ''
+        self._client = boto3.client('s3')
+
+    def _key(self, key):
+        if self.prefix:
+            return self.prefix + '/' + key
+        return key
+
+    def exists(self, key):
+        """Return True if key is cached"""
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def get(self, key, dest):
+        """Download key to dest, returns False if key isn't cached"""
+        try:
+            self._client.download_file(self.bucket, self._key(key), dest)
+        except ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def put(self, key, source):
+        """Upload source file as key"""
+        self._client.upload_file(source, self.bucket, self._key(key))
+
 
 
 class Source(object):
@@ -37,36 +89,121 @@ class Source(object):
 
 
     def _extract_zip(self, archive, dest):
-        """Unzip archive to dest"""
+        """
+        Unzip archive to dest
+
+        Directories are created up front and files are split across
+        a thread pool, zlib releases the GIL while inflating so
+        entries are extracted in parallel.
+        """
         zp = zipfile.ZipFile(archive, 'r')
-        zp.extractall(dest)
+        infos = zp.infolist()
         zip_dir = zp.namelist()[0]
-
         zp.close()
 
+        root = os.path.abspath(dest)
+        dirs = set([root])
+        # Keyed by target so the last of any duplicate entries wins
+        files = {}
+        for info in infos:
+            target = os.path.normpath(os.path.join(root, info.filename))
+            if not target.startswith(root + os.sep):
+                raise Exception('invalid path {} in archive'.format(
+                    info.filename))
+            if info.filename.endswith('/'):
+                dirs.add(target)
+            else:
+                dirs.add(os.path.dirname(target))
+                files[target] = info
+
+        for dir_name in sorted(dirs):
+            os.makedirs(dir_name, exist_ok=True)
+
+        # Balance workers by uncompressed size
+        files = sorted(((info, target) for target, info in files.items()),
+                       key=lambda f: f[0].file_size, reverse=True)
+        workers = min(EXTRACT_WORKERS, len(files)) or 1
+        batches = [files[idx::workers] for idx in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self._extract_batch,
+                              [archive] * workers, batches))
+
         # Return top level zip directory
         res_dir = os.path.join(dest, zip_dir)
         return res_dir
 
+    @staticmethod
+    def _extract_batch(archive, batch):
+        """Extract (ZipInfo, target path) pairs with a separate handle"""
+        with zipfile.ZipFile(archive, 'r') as zp:
+            for info, target in batch:
+                with zp.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
 
 class Github(Source):
-    def __init__(self, token, owner, repo, revision):
+    def __init__(self, token, owner, repo, revision, cache=None):
         self._github = github.Github(token)
         self._owner = owner
         self._repo = repo
         self._revision = revision
+        self._cache = cache
         self._tmp_dir = None
         self._file_name = "{}_{}_{}.zip".format(self._owner,
                 self._repo, self._revision)
 
+    def _download_archive(self, repo, revision):
+        arch_link = repo.get_archive_link('zipball', revision)
+        urllib.request.urlretrieve(arch_link, self.filepath())
+
+    def _cache_key(self, sha):
+        return '{}/{}/{}.zip'.format(self._owner, self._repo, sha)
+
     def download(self):
-        """Implement download() method"""
+        """
+        Implement download() method, if a cache is set the archive
+        is fetched from it and cached after downloading from Github.
+        """
         self._tmp_dir = tempfile.mkdtemp()
         repo = self._github.get_repo(self._owner + '/' + self._repo)
-        arch_link = repo.get_archive_link('zipball',
-                                          self._revision)
-        urllib.request.urlretrieve(arch_link,
-                os.path.join(self._tmp_dir, self._file_name))
+        if not self._cache:
+            self._download_archive(repo, self._revision)
+            return
+
+        # Download by commit so the archive always matches its key
+        sha = repo.get_commit(self._revision).sha
+        key = self._cache_key(sha)
+        try:
+            if self._cache.get(key, self.filepath()):
+                LOG.info("Source cache hit for %s" % key)
+                return
+        except ClientError as err:
+            LOG.warning("Source cache read of %s failed: %s" % (key, err))
+
+        LOG.info("Source cache miss for %s" % key)
+        self._download_archive(repo, sha)
+        try:
+            self._cache.put(key, self.filepath())
+        except (ClientError, S3UploadFailedError) as err:
+            LOG.warning("Source cache write of %s failed: %s" % (key, err))
+
+    def prefetch(self):
+        """Download the revision into the cache unless already cached"""
+        if not self._cache:
+            raise Exception('prefetch requires a source cache')
+
+        repo = self._github.get_repo(self._owner + '/' + self._repo)
+        sha = repo.get_commit(self._revision).sha
+        key = self._cache_key(sha)
+        if self._cache.exists(key):
+            LOG.info("Source %s already cached" % key)
+            return
+
+        self._tmp_dir = tempfile.mkdtemp()
+        self._download_archive(repo, sha)
+        self._cache.put(key, self.filepath())
+        LOG.info("Source %s prefetched" % key)
+        self.clean()
 
     def filepath(self):
         """Return file path"""
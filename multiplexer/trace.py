@@ -0,0 +1,153 @@
+'''Push to artifact latency tracing'''
+
+import calendar
+import json
+import os
+import re
+import sys
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+NAMESPACE = 'AWSCodeDeployMultiplexer'
+FORMATS = ('json', 'emf')
+
+# Environment variables used to carry a trace from the webhook to CodeBuild
+ENV_ID = 'MULTIPLEXER_TRACE_ID'
+ENV_COMMITTED = 'MULTIPLEXER_TRACE_COMMITTED'
+ENV_RECEIVED = 'MULTIPLEXER_TRACE_RECEIVED'
+ENV_QUEUED = 'MULTIPLEXER_TRACE_QUEUED'
+ENV_FORMAT = 'MULTIPLEXER_TRACE_FORMAT'
+
+# Spans summed into the stage totals of a timeline
+STAGES = ('fetch', 'extract', 'package', 'report', 'upload')
+
+
+def parse_timestamp(timestamp):
+    """Return epoch seconds of a Github ISO 8601 timestamp"""
+    timestamp = re.sub(r'Z$', '+0000', timestamp)
+    timestamp = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', timestamp)
+    parsed = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S%z')
+    return calendar.timegm(parsed.utctimetuple())
+
+
+def trace_id(delivery_id, committed):
+    """Return a trace ID for a push delivery and commit timestamp"""
+    if not delivery_id:
+        return None
+    return '{}-{}'.format(delivery_id, int(committed or 0))
+
+
+class Trace(object):
+    """
+    Timeline of a single push, from the commit to the uploaded artifact.
+
+    Spans are recorded with absolute epoch times so the webhook and
+    CodeBuild parts of a push can be combined into one timeline.
+    """
+    def __init__(self, trace_id=None, committed=None, received=None,
+                 queued=None):
+        self.trace_id = trace_id
+        self.committed = committed
+        self.received = received
+        self.queued = queued
+        self.started = time.time()
+        self.spans = []
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """
+        Load a trace passed on by the webhook, from the environment
+        or a dict of the same variables.
+        """
+        environ = os.environ if environ is None else environ
+
+        def _time(name):
+            value = environ.get(name)
+            return float(value) if value else None
+
+        return cls(environ.get(ENV_ID), _time(ENV_COMMITTED),
+                   _time(ENV_RECEIVED), _time(ENV_QUEUED))
+
+    def environment(self):
+        """Return the trace as CodeBuild environment variable overrides"""
+        values = [(ENV_ID, self.trace_id), (ENV_COMMITTED, self.committed),
+                  (ENV_RECEIVED, self.received), (ENV_QUEUED, self.queued)]
+        return [{'name': name, 'value': str(value)}
+                for name, value in values if value is not None]
+
+    def add_span(self, name, start, end, **attrs):
+        """Record a span of work"""
+        span = OrderedDict([('name', name), ('start', start), ('end', end),
+                            ('duration', round(end - start, 3))])
+        span.update(sorted(attrs.items()))
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Record the time spent within the context as a span"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.time(), **attrs)
+
+    def summary(self):
+        """Return the durations of each hop of the push"""
+        ended = time.time()
+        res = OrderedDict()
+        if self.committed and self.received:
+            res['commit_to_webhook'] = self.received - self.committed
+        if self.received and self.queued:
+            res['webhook'] = self.queued - self.received
+            res['queue'] = self.started - self.queued
+        elif self.received:
+            res['webhook'] = ended - self.received
+        res['build'] = ended - self.started
+        for stage in STAGES:
+            res[stage] = sum(s['duration'] for s in self.spans
+                             if s['name'] == stage)
+        res['total'] = ended - (self.committed or self.received or self.started)
+        return OrderedDict((k, round(v, 3)) for k, v in res.items())
+
+    def timeline(self):
+        """Return the trace as a dict"""
+        return OrderedDict([
+            ('trace_id', self.trace_id),
+            ('committed', self.committed),
+            ('received', self.received),
+            ('queued', self.queued),
+            ('started', self.started),
+            ('summary', self.summary()),
+            ('spans', self.spans),
+        ])
+
+    def emf(self):
+        """Return the trace summary in CloudWatch Embedded Metric Format"""
+        summary = self.summary()
+        obj = OrderedDict([
+            ('_aws', OrderedDict([
+                ('Timestamp', int(time.time() * 1000)),
+                ('CloudWatchMetrics', [OrderedDict([
+                    ('Namespace', NAMESPACE),
+                    ('Dimensions', [[]]),
+                    ('Metrics', [{'Name': name, 'Unit': 'Seconds'}
+                                 for name in summary]),
+                ])]),
+            ])),
+            ('TraceId', self.trace_id),
+        ])
+        obj.update(summary)
+        return obj
+
+    def emit(self, trace_format, stream=None):
+        """Write the trace as a single JSON line in json or emf format"""
+        if trace_format not in FORMATS:
+            raise ValueError('invalid trace format ' + trace_format)
+        obj = self.emf() if trace_format == 'emf' else self.timeline()
+        stream = stream or sys.stdout
+        stream.write(json.dumps(obj) + '\n')
+        stream.flush()
@@ -4,9 +4,11 @@ import hmac
 import json
 import logging
 import os
+import threading
+import time
 
 from os import path
-from multiplexer import config
+from multiplexer import config, report, trace
 
 import boto3
 
@@ -14,6 +16,13 @@ LOG = logging.getLogger()
 LOG.setLevel(logging.getLevelName(
     os.getenv('WEBHOOK_LOGLEVEL') or 'WARNING'))
 
+# Event key of actions run by asynchronous invocations of the function
+ACTION_KEY = 'multiplexer_action'
+
+# Seconds before the function times out to hand unfinished Lambda
+# builds over to CodeBuild
+LAMBDA_BUILD_MARGIN = 30
+
 
 def server_response(code, body):
     return {'statusCode': code, 'body': body}
@@ -44,11 +53,211 @@ def validate_signature(body, github_signature):
     return False
 
 
+def load_config():
+    """Load the configuration, applying the GITHUB_TOKEN override"""
+    conf = config.load_s3(os.getenv('MULTIPLEXER_CONFIG_BUCKET'),
+                          os.getenv('MULTIPLEXER_CONFIG_NAME'))
+    github_token = os.getenv('GITHUB_TOKEN')
+    if github_token:
+        conf._raw['github']['token'] = github_token
+    return conf
+
+
+def report_destination():
+    """Return the location of artifact reports in the artifact bucket"""
+    return 's3://{}/reports'.format(os.getenv('ARTIFACT_BUCKET'))
+
+
+def invoke_async(context, action, payload):
+    """
+    Invoke this function again asynchronously to run action once
+    the webhook has responded. The action is passed in the event
+    under ACTION_KEY alongside payload.
+    """
+    function_name = (context.function_name if context
+                     else os.getenv('AWS_LAMBDA_FUNCTION_NAME'))
+    event = dict(payload)
+    event[ACTION_KEY] = action
+    boto3.client('lambda').invoke(FunctionName=function_name,
+                                  InvocationType='Event',
+                                  Payload=json.dumps(event).encode('utf-8'))
+
+
+def start_build(artifact_names, push_trace, trace_format=None):
+    """Start a CodeBuild build of artifacts, passing the trace on"""
+    env_override = [
+        {
+            'name': 'ARTIFACTS',
+            'value': ' '.join(artifact_names),
+        }
+    ]
+    push_trace.queued = time.time()
+    env_override.extend(push_trace.environment())
+    if trace_format:
+        env_override.append({'name': trace.ENV_FORMAT, 'value': trace_format})
+
+    codebuild = boto3.client('codebuild')
+    codebuild.start_build(
+        projectName=os.getenv('MULTIPLEXER_CODEBUILD_PROJECT'),
+        environmentVariablesOverride=env_override
+    )
+
+
+def lambda_build_eligible(artifact, report_destination):
+    """
+    Return True if an artifact is small enough to build in the Lambda
+    function rather than CodeBuild.
+
+    An artifact is eligible when it has no more sources than
+    MULTIPLEXER_LAMBDA_MAX_SOURCES and, if MULTIPLEXER_LAMBDA_MAX_BYTES
+    is set, its previous report shows a package no larger than that.
+    Artifacts without a previous report, or whose report can't be read,
+    are left to CodeBuild.
+    """
+    max_sources = int(os.getenv('MULTIPLEXER_LAMBDA_MAX_SOURCES') or 0)
+    max_bytes = int(os.getenv('MULTIPLEXER_LAMBDA_MAX_BYTES') or 0)
+
+    if not max_sources or len(artifact['sources']) > max_sources:
+        return False
+
+    if not max_bytes:
+        return True
+
+    try:
+        previous = report.load_previous(
+            report_destination, report.report_name(artifact['name']))
+    except Exception as err:
+        LOG.warning("Reading previous report of %s failed: %s"
+                % (artifact['name'], err))
+        return False
+    if not previous:
+        LOG.info("No previous report for %s, size unknown" % artifact['name'])
+        return False
+
+    return previous['totals']['package_bytes'] <= max_bytes
+
+
+def lambda_build(artifact_names, conf, report_destination, push_trace=None):
+    """
+    Build artifacts within the Lambda function using /tmp as
+    workspace and upload them straight to the artifact bucket.
+
+    Returns the list of artifacts that failed to build.
+    """
+    # Imported here so the CodeBuild only path doesn't need build dependencies
+    from multiplexer import merge
+
+    destination = 's3://{}/{}'.format(os.getenv('ARTIFACT_BUCKET'),
+                                      int(time.time()))
+
+    failed = []
+    for name in artifact_names:
+        LOG.info("Building %s in Lambda" % name)
+        try:
+            merge.build_artifact(name, conf, destination,
+                                 report_destination=report_destination,
+                                 trace=push_trace,
+                                 source_cache=os.getenv('MULTIPLEXER_SOURCE_CACHE'),
+                                 pipeline=True)
+        except Exception as err:
+            LOG.warning("Lambda build of %s failed, falling back to CodeBuild: %s"
+                    % (name, err))
+            failed.append(name)
+    return failed
+
+
+def prefetch_source(conf, owner, repo, revision):
+    """
+    Download a pushed revision into the shared source cache so it is
+    cached by the time CodeBuild starts. Failures are only logged.
+    """
+    from multiplexer.source import Github, S3Cache
+
+    cache = S3Cache(os.getenv('MULTIPLEXER_SOURCE_CACHE'))
+    try:
+        Github(conf.github['token'], owner, repo, revision, cache).prefetch()
+    except Exception as err:
+        LOG.warning("Prefetch of %s/%s %s failed: %s"
+                % (owner, repo, revision, err))
+
+
+def build_handler(event, context):
+    '''
+    Builds artifacts in Lambda, invoked asynchronously by github_handler,
+    and starts CodeBuild for every artifact not built here. That includes
+    builds that fail, fail to start or are still running shortly before
+    the function times out.
+    '''
+    push_trace = trace.Trace.from_env(event.get('trace') or {})
+    trace_format = os.getenv(trace.ENV_FORMAT)
+    pending = list(event['artifacts'])
+    handed_over = []
+    lock = threading.Lock()
+
+    def _fallback():
+        with lock:
+            names = [n for n in pending if n not in handed_over]
+            if not names:
+                return
+            # Emit the spans recorded here first, the CodeBuild
+            # timeline shares the trace ID
+            if trace_format and push_trace.spans:
+                push_trace.emit(trace_format)
+            LOG.info("Starting CodeBuild for %s" % ', '.join(names))
+            start_build(names, push_trace, trace_format)
+            handed_over.extend(names)
+
+    timer = None
+    if context:
+        timeout = (context.get_remaining_time_in_millis() / 1000.0 -
+                   LAMBDA_BUILD_MARGIN)
+        timer = threading.Timer(max(timeout, 0), _fallback)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        conf = load_config()
+        for name in event['artifacts']:
+            with lock:
+                if handed_over:
+                    break
+            failed = lambda_build([name], conf, report_destination(),
+                                  push_trace)
+            with lock:
+                if not failed:
+                    pending.remove(name)
+    except Exception as err:
+        LOG.error("Lambda build failed: %s" % err)
+    finally:
+        if timer:
+            timer.cancel()
+        _fallback()
+
+    if trace_format and push_trace.spans and not handed_over:
+        push_trace.emit(trace_format)
+
+    return {'artifacts': event['artifacts'], 'failed': handed_over}
+
+
+def prefetch_handler(event, context):
+    '''
+    Prefetches a pushed revision, invoked asynchronously by github_handler
+    '''
+    prefetch_source(load_config(), event['owner'], event['repository'],
+                    event['revision'])
+    return {'owner': event['owner'], 'repository': event['repository'],
+            'revision': event['revision']}
+
+
 def github_handler(event, context):
     '''Parses Github events and kicks off CodeBuild'''
+    if event.get(ACTION_KEY) == 'build':
+        return build_handler(event, context)
+    if event.get(ACTION_KEY) == 'prefetch':
+        return prefetch_handler(event, context)
+
+    received = time.time()
     headers = event.get('headers', {})
-    config_bucket = os.getenv('MULTIPLEXER_CONFIG_BUCKET')
-    config_name = os.getenv('MULTIPLEXER_CONFIG_NAME')
 
     github_action_header = headers.get('X-GitHub-Event')
     if not github_action_header:
@@ -69,24 +278,49 @@ def github_handler(event, context):
     revision = path.basename(ref)
     source = github_body['repository']['full_name']
 
-    conf = config.load_s3(config_bucket, config_name)
+    committed = None
+    head_commit = github_body.get('head_commit') or {}
+    if head_commit.get('timestamp'):
+        committed = trace.parse_timestamp(head_commit['timestamp'])
+    push_trace = trace.Trace(
+        trace.trace_id(headers.get('X-GitHub-Delivery'), committed),
+        committed, received)
+    trace_format = os.getenv(trace.ENV_FORMAT)
+
+    conf = load_config()
     affected_artifacts = conf.lookup_artifacts(source, revision)
 
     artifact_names = []
+    lambda_names = []
     for artifact in affected_artifacts:
-        artifact_names.append(artifact['name'])
+        if lambda_build_eligible(artifact, report_destination()):
+            lambda_names.append(artifact['name'])
+        else:
+            artifact_names.append(artifact['name'])
 
-    project_name = os.getenv('MULTIPLEXER_CODEBUILD_PROJECT')
-    codebuild = boto3.client('codebuild')
-    codebuild.start_build(
-        projectName=project_name,
-        environmentVariablesOverride=[
-            {
-                'name': 'ARTIFACTS',
-                'value': ' '.join(artifact_names),
-            }
-        ]
-    )
+    # Start CodeBuild first, it takes longest to provision
+    if artifact_names or not lambda_names:
+        start_build(artifact_names, push_trace, trace_format)
+
+    # Build the rest after responding, the Github delivery times out
+    # long before a Lambda build completes
+    if lambda_names:
+        push_trace.queued = time.time()
+        invoke_async(context, 'build', {
+            'artifacts': lambda_names,
+            'trace': dict((var['name'], var['value'])
+                          for var in push_trace.environment()),
+        })
+
+    # Prefetch while CodeBuild provisions, unless no artifact uses the push
+    if (affected_artifacts and os.getenv('MULTIPLEXER_SOURCE_CACHE') and
+            os.getenv('MULTIPLEXER_PREFETCH') == 'true'):
+        owner, repo = source.split('/')
+        invoke_async(context, 'prefetch', {
+            'owner': owner,
+            'repository': repo,
+            'revision': github_body['after'],
+        })
 
     body = 'Recieved push to branch ' + revision + ' for ' + source
     return server_response(201, body)
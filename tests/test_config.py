@@ -1,5 +1,5 @@
 '''Configuration module test'''
-from multiplexer.config import Configuration, load_s3
+from multiplexer.config import Configuration, load_s3, parse_s3
 import pytest
 import boto3
 from moto import mock_s3
@@ -39,3 +39,24 @@ def test_lookup_artifacts():
     artifact_names = set([a['name'] for a in artifacts])
 
     assert len(exp_artifacts.difference(artifact_names)) == 0
+
+
+def test_artifact_settings():
+    '''Test artifact settings are kept'''
+
+    body = '''{"sources":{"app1":{"type":"github","owner":"myorg","repository":"app1"}},"artifacts":[{"name":"production/allapps","size_budget":1024,"sources":[{"name":"app1","revision":"prod"}]}]}'''
+
+    config = Configuration(body)
+    artifact = config.artifact('production/allapps')
+
+    assert artifact['size_budget'] == 1024
+    assert list(artifact['sources'].keys()) == ['app1']
+
+
+def test_parse_s3():
+    '''Test S3 location parsing'''
+    assert parse_s3('s3://artifacts-us-west-2/builds/v1.2-rc') == (
+        'artifacts-us-west-2', 'builds/v1.2-rc')
+    assert parse_s3('s3://artifacts/builds/') == ('artifacts', 'builds')
+    assert parse_s3('s3://artifacts') == ('artifacts', None)
+    assert parse_s3('/tmp/artifacts') is None
@@ -1,7 +1,15 @@
 '''Configuration module test'''
+import gc
+import io
+import json
 import os
-from multiplexer.merge import AppSpec, Package
+import sys
+import tarfile
+from multiplexer import merge
+from multiplexer.merge import AppSpec, Package, build_artifact, store_package
 import pytest
+import boto3
+from moto import mock_s3
 
 
 def test_package():
@@ -35,6 +43,32 @@ def test_package():
     assert not os.path.isdir(pkg._tmp_workspace)
 
 
+@pytest.mark.parametrize('package_format', ['tar', 'tgz'])
+def test_package_tar(tmpdir, package_format):
+    '''Test streamed tar packaging'''
+    curr_location = os.path.dirname(os.path.realpath(__file__))
+
+    pkg = Package('myartifact', str(tmpdir), package_format)
+    assert pkg.name == 'myartifact.' + package_format
+
+    pkg.add_file('testfile',
+                 source=os.path.join(curr_location, 'testfile'))
+    pkg.add_directory('src')
+    pkg.add_file('src/testfile2', body='Another test file')
+    pkg.add_directory('scripts', source=os.path.join(curr_location, 'testdir'))
+
+    pkg_path = pkg.create()
+    pkg.clean_tmp()
+
+    with tarfile.open(pkg_path, 'r:*') as tf:
+        names = tf.getnames()
+        body = tf.extractfile('src/testfile2').read()
+
+    assert body == b'Another test file'
+    for name in ['testfile', 'src', 'src/testfile2', 'scripts/another_testfile']:
+        assert name in names
+
+
 def test_load_appspec():
     '''Test Appspec Load'''
 
@@ -130,3 +164,126 @@ hooks:
     ]
 
     assert expect_before_install == res_appspec.hooks['BeforeInstall']
+
+
+@mock_s3
+def test_store_package(tmpdir):
+    '''Test storing a package in several destinations'''
+    source = str(tmpdir.join('myartifact.tgz'))
+    with open(source, 'wb') as fil:
+        fil.write(b'package')
+
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='artifacts-east')
+    s3.create_bucket(Bucket='artifacts-west')
+
+    local_dest = str(tmpdir.join('local'))
+    destinations = ['s3://artifacts-east/builds', 's3://artifacts-west',
+                    's3://artifacts-missing', local_dest]
+    results = store_package(source, destinations, part_size=5 * 1024 * 1024,
+                            concurrency=2)
+
+    assert list(results.keys()) == destinations
+    assert results['s3://artifacts-east/builds'] is None
+    assert results['s3://artifacts-west'] is None
+    assert results['s3://artifacts-missing'] is not None
+    assert results[local_dest] is None
+
+    obj = s3.head_object(Bucket='artifacts-east', Key='builds/myartifact.tgz')
+    assert obj['Metadata']['bundle-type'] == 'tgz'
+    s3.head_object(Bucket='artifacts-west', Key='myartifact.tgz')
+    assert os.path.isfile(os.path.join(local_dest, 'myartifact.tgz'))
+
+
+class FakeConfig(object):
+    '''Configuration stand-in with a single artifact'''
+    github = {'token': None}
+
+    def __init__(self, **settings):
+        self.settings = settings
+
+    def artifact(self, name):
+        artifact = {'name': name, 'sources': {'app1': {'repository': 'app1'}}}
+        artifact.update(self.settings)
+        return artifact
+
+
+@pytest.fixture
+def local_sources(tmpdir, monkeypatch):
+    '''Serve the app1 source from a local directory'''
+    src_dir = tmpdir.mkdir('app1')
+    src_dir.join('index.js').write('console.log(1)' * 10)
+
+    def _fetch_sources(name, artifact, config, workspace, cache=None, trace=None):
+        yield 'app1', artifact['sources']['app1'], str(src_dir)
+
+    monkeypatch.setattr(merge, 'fetch_sources', _fetch_sources)
+    return src_dir
+
+
+def test_build_artifact_cleanup(tmpdir, monkeypatch, local_sources):
+    '''Test the workspace is removed when a build fails'''
+    workspace = tmpdir.mkdir('workspace')
+    monkeypatch.setattr(merge.tempfile, 'mkdtemp', lambda: str(workspace))
+
+    out = tmpdir.mkdir('out')
+    out.join('myartifact.report.json').write('{}')
+
+    with pytest.raises(Exception) as err:
+        build_artifact('myartifact', FakeConfig(size_budget=10), str(out))
+    assert 'size budget' in str(err.value)
+    assert not workspace.check()
+
+    # Neither the package nor its report replace the previous build
+    assert not out.join('myartifact.zip').check()
+    assert out.join('myartifact.report.json').read() == '{}'
+
+
+def test_build_artifact_tar_report(tmpdir, monkeypatch, local_sources):
+    '''Test tar package reports are built without reading the package back'''
+    def _from_tar(*args, **kwargs):
+        raise AssertionError('package read back')
+    monkeypatch.setattr(merge.report.Report, 'from_tar', _from_tar)
+
+    out = tmpdir.join('out')
+    build_artifact('myartifact', FakeConfig(format='tgz'), str(out))
+
+    summary = json.loads(out.join('myartifact.report.json').read())
+    assert summary['totals']['files'] == 2
+    assert summary['sources']['app1']['uncompressed_bytes'] == len('console.log(1)' * 10)
+    assert summary['totals']['package_bytes'] == out.join('myartifact.tgz').size()
+
+
+def test_build_artifact_local_destinations(tmpdir, local_sources):
+    '''Test local destinations get the same layout however many there are'''
+    one, first, second = tmpdir.join('one'), tmpdir.join('a'), tmpdir.join('b')
+    build_artifact('production/allapps', FakeConfig(), str(one))
+    build_artifact('production/allapps', FakeConfig(), [str(first), str(second)])
+
+    for dest in (one, first, second):
+        assert dest.join('production', 'allapps.zip').check(file=1)
+    assert first.join('production', 'allapps.report.json').check(file=1)
+
+
+@pytest.mark.parametrize('package_format', ['zip', 'tar', 'tgz'])
+def test_package_abort(tmpdir, monkeypatch, package_format):
+    '''Test aborted packages don't write to their closed file object'''
+    unraisable = []
+    monkeypatch.setattr(sys, 'unraisablehook', unraisable.append)
+    curr_location = os.path.dirname(os.path.realpath(__file__))
+
+    fileobj = io.BytesIO()
+    pkg = Package('myartifact', str(tmpdir), package_format, fileobj=fileobj)
+    pkg.add_directory('scripts', source=os.path.join(curr_location, 'testdir'))
+    pkg.abort()
+    fileobj.close()
+    del pkg
+    gc.collect()
+    assert not unraisable
+
+    # Packages written under root are removed
+    pkg = Package('myartifact', str(tmpdir), package_format)
+    pkg.add_file('testfile2', body='Another test file')
+    pkg.abort()
+    pkg.clean_tmp()
+    assert not tmpdir.join('myartifact.' + package_format).check()
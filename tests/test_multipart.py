@@ -0,0 +1,103 @@
+'''Multipart module test'''
+import io
+import os
+import threading
+import zipfile
+from multiplexer.merge import Package, pipelined
+from multiplexer.multipart import MIN_PART_SIZE, MultipartUploadWriter, parse_destination
+import pytest
+import boto3
+from moto import mock_s3
+
+PART_SIZE = 5 * 1024 * 1024
+
+
+@mock_s3
+def test_streamed_package(tmpdir, monkeypatch):
+    '''Test streaming a zip package into multipart uploads'''
+    # moto doesn't decode checksummed upload_part bodies
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='artifacts-east')
+    s3.create_bucket(Bucket='artifacts-west')
+
+    src_dir = tmpdir.mkdir('app1')
+    src_dir.join('big.bin').write_binary(os.urandom(PART_SIZE + 1024))
+    src_dir.join('index.js').write('console.log(1)')
+
+    destinations = [parse_destination(dest, 'myartifact.zip') for dest in
+                    ['s3://artifacts-east/builds', 's3://artifacts-west',
+                     's3://artifacts-missing']]
+    assert destinations[0] == ('s3://artifacts-east/builds', 'artifacts-east',
+                               'builds/myartifact.zip')
+
+    writer = MultipartUploadWriter(destinations, PART_SIZE, 2,
+                                   'application/zip', {'bundle-type': 'zip'})
+    # Concurrency applies per destination
+    assert writer._executor._max_workers == 6
+    pkg = Package('myartifact', str(tmpdir), 'zip', fileobj=writer)
+    pkg.add_directory('app1', source=str(src_dir))
+    pkg.add_file('appspec.yml', body='version: 0.0\n')
+    pkg.create()
+
+    entries = dict((e[0], e[2]) for e in pkg.entries())
+    assert entries['app1/index.js'] == len('console.log(1)')
+    assert 'appspec.yml' in entries
+
+    results = writer.complete()
+    assert results['s3://artifacts-east/builds'] is None
+    assert results['s3://artifacts-west'] is None
+    assert results['s3://artifacts-missing'] is not None
+
+    obj = s3.get_object(Bucket='artifacts-east', Key='builds/myartifact.zip')
+    assert obj['Metadata']['bundle-type'] == 'zip'
+    body = obj['Body'].read()
+    assert len(body) == writer.size
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        assert zf.read('appspec.yml') == b'version: 0.0\n'
+        assert zf.testzip() is None
+
+
+@mock_s3
+def test_part_size():
+    '''Test part sizes below the S3 minimum are raised to it'''
+    boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='artifacts')
+    destinations = [parse_destination('s3://artifacts', 'myartifact.zip')]
+
+    writer = MultipartUploadWriter(destinations, 1024, 2)
+    assert writer.part_size == MIN_PART_SIZE
+    writer.abort()
+
+    writer = MultipartUploadWriter(destinations, PART_SIZE * 2, 2)
+    assert writer.part_size == PART_SIZE * 2
+    writer.abort()
+
+
+def test_pipelined():
+    '''Test pipelined iteration keeps order and raises errors'''
+    assert list(pipelined(iter(range(10)), 1)) == list(range(10))
+
+    def _failing():
+        yield 1
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        list(pipelined(_failing(), 1))
+
+
+def test_pipelined_close():
+    '''Test the producer stops once the consumer is gone'''
+    produced = []
+
+    def _source():
+        for item in range(10):
+            produced.append(item)
+            yield item
+
+    threads = threading.active_count()
+    items = pipelined(_source(), 1)
+    assert next(items) == 0
+    items.close()
+
+    assert threading.active_count() == threads
+    assert len(produced) < 10
@@ -0,0 +1,29 @@
+'''Parallel gzip module test'''
+import gzip
+import os
+from multiplexer.pgzip import ParallelGzipFile
+import pytest
+
+
+def test_parallel_gzip(tmpdir):
+    '''Test output is readable by standard gzip'''
+    pth = str(tmpdir.join('test.gz'))
+    data = os.urandom(100000) + b'compressible ' * 50000
+
+    with ParallelGzipFile(open(pth, 'wb'), block_size=32 * 1024,
+                          workers=4) as gz:
+        for idx in range(0, len(data), 10000):
+            gz.write(data[idx:idx + 10000])
+
+    with gzip.open(pth, 'rb') as fil:
+        assert fil.read() == data
+    assert os.path.getsize(pth) < len(data)
+
+
+def test_parallel_gzip_empty(tmpdir):
+    '''Test empty output'''
+    pth = str(tmpdir.join('empty.gz'))
+    ParallelGzipFile(open(pth, 'wb')).close()
+
+    with gzip.open(pth, 'rb') as fil:
+        assert fil.read() == b''
@@ -0,0 +1,76 @@
+'''Report module test'''
+import json
+import os
+import zipfile
+from multiplexer.report import Report, load_previous, report_name, store
+import pytest
+
+
+def _package(pth):
+    zf = zipfile.ZipFile(pth, 'w', zipfile.ZIP_DEFLATED)
+    zf.writestr('appspec.yml', 'version: 0.0\n')
+    zf.writestr('app1/src/index.js', 'a' * 4096)
+    zf.writestr('app1/vendor/lib.js', 'b' * 8192)
+    zf.writestr('app2/README', 'readme')
+    zf.close()
+
+
+def test_report(tmpdir):
+    '''Test report summary, diff and storage'''
+    pkg_path = str(tmpdir.join('myartifact.zip'))
+    _package(pkg_path)
+
+    report = Report.from_zip('myartifact', pkg_path)
+    summary = report.summary()
+
+    assert summary['totals']['files'] == 4
+    assert summary['sources']['app1']['files'] == 2
+    assert summary['sources']['app1']['uncompressed_bytes'] == 4096 + 8192
+    assert summary['sources']['<root>']['files'] == 1
+    assert summary['largest_files'][0]['path'] == 'app1/vendor/lib.js'
+    assert summary['largest_directories'][0]['path'] == 'app1'
+    assert summary['extensions']['.js']['ratio'] < 1
+    assert '<none>' in summary['extensions']
+
+    name = report_name('myartifact')
+    assert name == 'myartifact.report.json'
+    assert load_previous(str(tmpdir), name) is None
+
+    store(str(tmpdir), name, report.serialize())
+    previous = load_previous(str(tmpdir), name)
+    assert previous['diff'] is None
+
+    with zipfile.ZipFile(pkg_path, 'a', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('app3/big.bin', os.urandom(1024))
+
+    diff = json.loads(Report.from_zip('myartifact', pkg_path).serialize(previous))['diff']
+    assert diff['totals']['files'] == 1
+    assert diff['sources']['app3']['uncompressed_bytes'] == 1024
+    assert diff['sources']['app1']['files'] == 0
+
+
+def test_report_budget(tmpdir):
+    '''Test size budget'''
+    pkg_path = str(tmpdir.join('myartifact.zip'))
+    _package(pkg_path)
+
+    report = Report.from_zip('myartifact', pkg_path)
+    report.check_budget(None)
+    report.check_budget(os.path.getsize(pkg_path))
+
+    with pytest.raises(Exception):
+        report.check_budget(100)
+
+
+def test_report_name(tmpdir):
+    '''Test reports of artifacts sharing a base name are kept apart'''
+    assert report_name('production/allapps') == 'production/allapps.report.json'
+
+    pkg_path = str(tmpdir.join('allapps.zip'))
+    _package(pkg_path)
+    for name in ('production/allapps', 'staging/allapps'):
+        store(str(tmpdir), report_name(name),
+              Report.from_zip(name, pkg_path).serialize())
+
+    assert load_previous(str(tmpdir), report_name('production/allapps'))['artifact'] == 'production/allapps'
+    assert load_previous(str(tmpdir), report_name('staging/allapps'))['artifact'] == 'staging/allapps'
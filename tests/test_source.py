@@ -0,0 +1,129 @@
+'''Source module test'''
+import os
+import zipfile
+from multiplexer.source import Github, S3Cache, Source
+import pytest
+import boto3
+from moto import mock_s3
+
+
+class FakeCommit(object):
+    sha = 'abc123'
+
+
+class FakeRepo(object):
+    '''Github repository returning a local file as its archive'''
+    def __init__(self, archive):
+        self.archive = archive
+        self.archive_requests = []
+
+    def get_commit(self, revision):
+        return FakeCommit()
+
+    def get_archive_link(self, archive_format, revision):
+        self.archive_requests.append(revision)
+        return 'file://' + self.archive
+
+
+class FakeGithub(object):
+    def __init__(self, repo):
+        self.repo = repo
+
+    def get_repo(self, name):
+        return self.repo
+
+
+@mock_s3
+def test_github_cache(tmpdir):
+    '''Test sources are cached in S3 by commit'''
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='sourcecache')
+    cache = S3Cache('s3://sourcecache/sources')
+
+    archive = str(tmpdir.join('archive.zip'))
+    with open(archive, 'wb') as fil:
+        fil.write(b'archive')
+    repo = FakeRepo(archive)
+
+    assert not cache.exists('myorg/app1/abc123.zip')
+
+    src = Github('token', 'myorg', 'app1', 'master', cache)
+    src._github = FakeGithub(repo)
+    src.download()
+    src.clean()
+
+    # Archive downloaded by commit and cached
+    assert repo.archive_requests == ['abc123']
+    assert cache.exists('myorg/app1/abc123.zip')
+    s3.head_object(Bucket='sourcecache', Key='sources/myorg/app1/abc123.zip')
+
+    src = Github('token', 'myorg', 'app1', 'master', cache)
+    src._github = FakeGithub(repo)
+    src.download()
+    with open(src.filepath(), 'rb') as fil:
+        assert fil.read() == b'archive'
+    src.clean()
+
+    # Served from the cache
+    assert repo.archive_requests == ['abc123']
+
+    # Prefetch skips cached revisions
+    src = Github('token', 'myorg', 'app1', 'abc123', cache)
+    src._github = FakeGithub(repo)
+    src.prefetch()
+    assert repo.archive_requests == ['abc123']
+
+
+@mock_s3
+def test_github_cache_write_error(tmpdir):
+    '''Test a failed cache write doesn't fail the download'''
+    boto3.client('s3', region_name='us-east-1')
+    cache = S3Cache('s3://missing-sourcecache/sources')
+
+    archive = str(tmpdir.join('archive.zip'))
+    with open(archive, 'wb') as fil:
+        fil.write(b'archive')
+    repo = FakeRepo(archive)
+
+    src = Github('token', 'myorg', 'app1', 'master', cache)
+    src._github = FakeGithub(repo)
+    src.download()
+    with open(src.filepath(), 'rb') as fil:
+        assert fil.read() == b'archive'
+    src.clean()
+    assert repo.archive_requests == ['abc123']
+
+
+def test_extract_zip(tmpdir):
+    '''Test threaded extraction'''
+    archive = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('myorg-app1-abc123/', '')
+        zf.writestr('myorg-app1-abc123/empty/', '')
+        for idx in range(50):
+            zf.writestr('myorg-app1-abc123/src/{}/file{}.txt'.format(idx % 7, idx),
+                        'file {}'.format(idx) * idx)
+        zf.writestr('myorg-app1-abc123/appspec.yml', 'version: 0.0\n')
+        zf.writestr('myorg-app1-abc123/appspec.yml', 'version: 0.0\n')
+
+    dest = str(tmpdir.mkdir('dest'))
+    res = Source()._extract_zip(archive, dest)
+
+    assert res == os.path.join(dest, 'myorg-app1-abc123/')
+    assert os.path.isdir(os.path.join(res, 'empty'))
+    with open(os.path.join(res, 'appspec.yml')) as fil:
+        assert fil.read() == 'version: 0.0\n'
+    with open(os.path.join(res, 'src/6/file48.txt')) as fil:
+        assert fil.read() == 'file 48' * 48
+
+
+def test_extract_zip_invalid_path(tmpdir):
+    '''Test archives can't write outside dest'''
+    archive = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('top/', '')
+        zf.writestr('../escape.txt', 'escape')
+
+    with pytest.raises(Exception):
+        Source()._extract_zip(archive, str(tmpdir.mkdir('dest')))
+    assert not os.path.exists(str(tmpdir.join('escape.txt')))
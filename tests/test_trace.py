@@ -0,0 +1,47 @@
+'''Trace module test'''
+import io
+import json
+import time
+from multiplexer.trace import Trace, parse_timestamp, trace_id
+import pytest
+
+
+def test_parse_timestamp():
+    '''Test Github timestamps'''
+    assert parse_timestamp('2017-05-01T12:00:00Z') == 1493640000
+    assert parse_timestamp('2017-05-01T05:00:00-07:00') == 1493640000
+    assert trace_id('abc-123', 1493640000.0) == 'abc-123-1493640000'
+    assert trace_id(None, 1493640000) is None
+
+
+def test_trace_env(monkeypatch):
+    '''Test trace is carried from the webhook to CodeBuild'''
+    now = time.time()
+    webhook_trace = Trace('abc-1', now - 60, now - 10)
+    webhook_trace.queued = now - 5
+
+    for var in webhook_trace.environment():
+        monkeypatch.setenv(var['name'], var['value'])
+
+    build_trace = Trace.from_env()
+    assert build_trace.trace_id == 'abc-1'
+    assert build_trace.queued == pytest.approx(now - 5)
+
+    with build_trace.span('fetch', artifact='myartifact', source='app1'):
+        pass
+
+    stream = io.StringIO()
+    build_trace.emit('json', stream)
+    timeline = json.loads(stream.getvalue())
+    assert timeline['trace_id'] == 'abc-1'
+    assert timeline['spans'][0]['source'] == 'app1'
+    assert timeline['summary']['webhook'] == pytest.approx(5, abs=0.01)
+    assert timeline['summary']['queue'] == pytest.approx(5, abs=0.1)
+    assert timeline['summary']['commit_to_webhook'] == pytest.approx(50, abs=0.01)
+
+    stream = io.StringIO()
+    build_trace.emit('emf', stream)
+    emf = json.loads(stream.getvalue())
+    metrics = [m['Name'] for m in emf['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert 'queue' in metrics
+    assert emf['TraceId'] == 'abc-1'
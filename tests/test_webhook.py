@@ -0,0 +1,261 @@
+'''Webhook module test'''
+import json
+import os
+import time
+from multiplexer import webhook
+from multiplexer.webhook import lambda_build_eligible
+from webhook_load import percentile, push_event, replay, run
+import pytest
+import boto3
+from moto import mock_s3
+
+
+ARTIFACT = {'name': 'production/allapps',
+            'sources': {'app1': {}, 'app2': {}}}
+
+CONFIG = {
+    'sources': {
+        'app1': {'type': 'github', 'owner': 'org', 'repository': 'app1'},
+        'app2': {'type': 'github', 'owner': 'org', 'repository': 'app2'},
+    },
+    'artifacts': [
+        {'name': 'production/small',
+         'sources': [{'name': 'app1', 'revision': 'master'}]},
+        {'name': 'production/allapps',
+         'sources': [{'name': 'app1', 'revision': 'master'},
+                     {'name': 'app2', 'revision': 'master'}]},
+    ],
+}
+
+
+class Recorder(object):
+    '''Records the arguments of each call'''
+    def __init__(self, result=None):
+        self.calls = []
+        self.result = result
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        return self.result
+
+
+@mock_s3
+def test_lambda_build_eligible(monkeypatch):
+    '''Test in-Lambda build thresholds'''
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='artifacts')
+    report_destination = 's3://artifacts/reports'
+
+    # Disabled unless a source threshold is set
+    assert not lambda_build_eligible(ARTIFACT, report_destination)
+
+    monkeypatch.setenv('MULTIPLEXER_LAMBDA_MAX_SOURCES', '1')
+    assert not lambda_build_eligible(ARTIFACT, report_destination)
+
+    monkeypatch.setenv('MULTIPLEXER_LAMBDA_MAX_SOURCES', '2')
+    assert lambda_build_eligible(ARTIFACT, report_destination)
+
+    # Size unknown without a previous report
+    monkeypatch.setenv('MULTIPLEXER_LAMBDA_MAX_BYTES', '1024')
+    assert not lambda_build_eligible(ARTIFACT, report_destination)
+
+    report = {'totals': {'package_bytes': 512}}
+    s3.put_object(Bucket='artifacts', Key='reports/production/allapps.report.json',
+                  Body=json.dumps(report))
+    assert lambda_build_eligible(ARTIFACT, report_destination)
+
+    report['totals']['package_bytes'] = 4096
+    s3.put_object(Bucket='artifacts', Key='reports/production/allapps.report.json',
+                  Body=json.dumps(report))
+    assert not lambda_build_eligible(ARTIFACT, report_destination)
+
+    # Unreadable reports leave the artifact to CodeBuild
+    assert not lambda_build_eligible(ARTIFACT, 's3://missing/reports')
+
+
+@mock_s3
+def test_github_handler(monkeypatch):
+    '''Test pushes start CodeBuild and hand small artifacts to an async build'''
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='config')
+    s3.put_object(Bucket='config', Key='multiplexer.json',
+                  Body=json.dumps(CONFIG))
+    monkeypatch.setenv('MULTIPLEXER_CONFIG_BUCKET', 'config')
+    monkeypatch.setenv('MULTIPLEXER_CONFIG_NAME', 'multiplexer.json')
+    monkeypatch.setenv('WEBHOOK_SECRET', 'loadtest-secret')
+    monkeypatch.setenv('ARTIFACT_BUCKET', 'artifacts')
+    monkeypatch.setenv('MULTIPLEXER_LAMBDA_MAX_SOURCES', '1')
+    monkeypatch.delenv('GITHUB_TOKEN', raising=False)
+    monkeypatch.delenv('MULTIPLEXER_PREFETCH', raising=False)
+    start_build = Recorder()
+    invoke_async = Recorder()
+    monkeypatch.setattr(webhook, 'start_build', start_build)
+    monkeypatch.setattr(webhook, 'invoke_async', invoke_async)
+
+    event = push_event(json.dumps({
+        'ref': 'refs/heads/master',
+        'after': 'abc123',
+        'repository': {'full_name': 'org/app1'},
+        'head_commit': {'timestamp': '2017-06-01T12:00:00Z'},
+    }))
+    assert webhook.github_handler(event, None)['statusCode'] == 201
+
+    assert len(start_build.calls) == 1
+    assert start_build.calls[0][0] == ['production/allapps']
+
+    assert len(invoke_async.calls) == 1
+    _, action, payload = invoke_async.calls[0]
+    assert action == 'build'
+    assert payload['artifacts'] == ['production/small']
+    assert payload['trace']['MULTIPLEXER_TRACE_ID'].endswith('-1496318400')
+
+    # Prefetching is handed to another async invocation
+    monkeypatch.setenv('MULTIPLEXER_SOURCE_CACHE', 's3://artifacts/source-cache')
+    monkeypatch.setenv('MULTIPLEXER_PREFETCH', 'true')
+    assert webhook.github_handler(event, None)['statusCode'] == 201
+    _, action, payload = invoke_async.calls[-1]
+    assert action == 'prefetch'
+    assert payload == {'owner': 'org', 'repository': 'app1',
+                       'revision': 'abc123'}
+
+    prefetch_source = Recorder()
+    monkeypatch.setattr(webhook, 'prefetch_source', prefetch_source)
+    payload[webhook.ACTION_KEY] = action
+    webhook.github_handler(payload, None)
+    assert prefetch_source.calls[0][1:] == ('org', 'app1', 'abc123')
+
+    # Pushes no artifact uses aren't prefetched
+    invocations = len(invoke_async.calls)
+    event = push_event(json.dumps({
+        'ref': 'refs/heads/feature',
+        'after': 'def456',
+        'repository': {'full_name': 'org/app1'},
+    }))
+    assert webhook.github_handler(event, None)['statusCode'] == 201
+    assert len(invoke_async.calls) == invocations
+
+
+class FakeContext(object):
+    '''Lambda context stand-in'''
+    function_name = 'multiplexer'
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+BUILD_EVENT = {webhook.ACTION_KEY: 'build',
+               'artifacts': ['production/small', 'staging/small'],
+               'trace': {'MULTIPLEXER_TRACE_ID': 'delivery-1',
+                         'MULTIPLEXER_TRACE_RECEIVED': '100.0'}}
+
+
+@pytest.fixture
+def build_handler_env(monkeypatch):
+    '''Stand-ins for the configuration and CodeBuild'''
+    monkeypatch.delenv('MULTIPLEXER_TRACE_FORMAT', raising=False)
+    monkeypatch.setattr(webhook, 'load_config', lambda: None)
+    start_build = Recorder()
+    monkeypatch.setattr(webhook, 'start_build', start_build)
+    return start_build
+
+
+def test_build_handler(monkeypatch, capsys, build_handler_env):
+    '''Test async Lambda builds fall back to CodeBuild'''
+    start_build = build_handler_env
+
+    monkeypatch.setattr(webhook, 'lambda_build', Recorder([]))
+    res = webhook.github_handler(BUILD_EVENT, None)
+    assert res['failed'] == []
+    assert not start_build.calls
+
+    def _lambda_build(artifact_names, conf, report_destination, push_trace):
+        lambda_build.calls.append((artifact_names, conf, report_destination,
+                                   push_trace))
+        push_trace.add_span('package', 101.0, 102.0, artifact=artifact_names[0])
+        return [n for n in artifact_names if n.startswith('staging/')]
+    lambda_build = Recorder()
+    monkeypatch.setattr(webhook, 'lambda_build', _lambda_build)
+    monkeypatch.setenv('MULTIPLEXER_TRACE_FORMAT', 'json')
+    capsys.readouterr()
+    res = webhook.github_handler(BUILD_EVENT, None)
+
+    # Spans recorded before falling back are emitted under the same trace
+    timeline = json.loads(capsys.readouterr().out)
+    assert timeline['trace_id'] == 'delivery-1'
+    assert timeline['spans'][0]['artifact'] == 'production/small'
+    assert [c[0] for c in lambda_build.calls] == [['production/small'],
+                                                  ['staging/small']]
+    assert lambda_build.calls[0][3].trace_id == 'delivery-1'
+    assert res['failed'] == ['staging/small']
+    assert start_build.calls[0][0] == ['staging/small']
+    assert start_build.calls[0][1].trace_id == 'delivery-1'
+
+
+def test_build_handler_error(monkeypatch, build_handler_env):
+    '''Test every artifact goes to CodeBuild if the Lambda build can't run'''
+    start_build = build_handler_env
+
+    def _lambda_build(*args):
+        raise ImportError('No module named github')
+    monkeypatch.setattr(webhook, 'lambda_build', _lambda_build)
+
+    res = webhook.github_handler(BUILD_EVENT, None)
+    assert res['failed'] == BUILD_EVENT['artifacts']
+    assert start_build.calls[0][0] == BUILD_EVENT['artifacts']
+
+
+def test_build_handler_timeout(monkeypatch, build_handler_env):
+    '''Test unfinished artifacts go to CodeBuild before the function times out'''
+    start_build = build_handler_env
+
+    def _lambda_build(*args):
+        time.sleep(0.3)
+        return []
+    monkeypatch.setattr(webhook, 'lambda_build', _lambda_build)
+
+    context = FakeContext(webhook.LAMBDA_BUILD_MARGIN * 1000 + 50)
+    res = webhook.github_handler(BUILD_EVENT, context)
+    assert res['failed'] == BUILD_EVENT['artifacts']
+    assert len(start_build.calls) == 1
+    assert start_build.calls[0][0] == BUILD_EVENT['artifacts']
+
+
+def test_load_harness(tmpdir):
+    '''Test webhook load harness against the stand-ins'''
+    environ = dict(os.environ)
+
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 99) == 4
+
+    summary = run(requests=20, concurrency=4, artifacts=50, sources=10,
+                  seed=1)
+    assert summary['requests'] == 20
+    assert summary['errors'] == 0
+    assert summary['p50'] <= summary['p95'] <= summary['p99']
+
+    recorded = tmpdir.join('payloads.jsonl')
+    recorded.write(json.dumps({'ref': 'refs/heads/master',
+                               'after': 'abc123',
+                               'repository': {'full_name': 'org1/app1'}}) + '\n')
+    summary = run(requests=5, concurrency=2, artifacts=50, sources=10,
+                  payloads=str(recorded), seed=1)
+    assert summary['statuses'] == {'201': 5}
+
+    # The harness leaves the environment as it found it
+    assert dict(os.environ) == environ
+
+
+def test_replay_queueing(monkeypatch):
+    '''Test latency includes the wait for a free worker'''
+    def _handler(event, context):
+        time.sleep(0.05)
+        return {'statusCode': 201}
+    monkeypatch.setattr(webhook, 'github_handler', _handler)
+
+    summary = replay([{}] * 4, rate=1000, concurrency=1)
+    assert summary['statuses'] == {'201': 4}
+    # The last event waits behind three others
+    assert summary['max'] >= 0.19
@@ -0,0 +1,275 @@
+'''
+Webhook load harness
+
+Replays recorded or synthetic Github push deliveries against
+multiplexer.webhook.github_handler at a configurable rate and
+concurrency, with moto standing in for S3 and CodeBuild, and
+reports latency percentiles and throughput.
+
+    python tests/webhook_load.py --requests 2000 --concurrency 20 --rate 200
+    python tests/webhook_load.py --payloads recorded/ --format json
+'''
+
+import hmac
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from unittest import mock
+
+import boto3
+from moto import mock_codebuild, mock_s3
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from multiplexer import webhook
+
+CONFIG_BUCKET = 'multiplexer-loadtest'
+CONFIG_NAME = 'multiplexer.json'
+PROJECT_NAME = 'multiplexer-loadtest'
+SECRET = 'loadtest-secret'
+REVISIONS = ('master', 'staging', 'production')
+
+
+def synthetic_config(artifacts, sources, sources_per_artifact, rng):
+    """Return a configuration dict with the given number of artifacts"""
+    conf = {'sources': OrderedDict(), 'artifacts': []}
+    for idx in range(sources):
+        conf['sources']['app{}'.format(idx)] = {
+            'type': 'github',
+            'owner': 'org{}'.format(idx % 10),
+            'repository': 'app{}'.format(idx),
+        }
+
+    names = list(conf['sources'])
+    for idx in range(artifacts):
+        count = min(sources_per_artifact, len(names))
+        conf['artifacts'].append({
+            'name': '{}/artifact{}'.format(rng.choice(REVISIONS), idx),
+            'sources': [{'name': name, 'revision': rng.choice(REVISIONS)}
+                        for name in rng.sample(names, count)],
+        })
+    return conf
+
+
+def synthetic_payload(conf, rng):
+    """Return a push delivery body for a random configured source"""
+    src = conf['sources'][rng.choice(list(conf['sources']))]
+    return json.dumps({
+        'ref': 'refs/heads/' + rng.choice(REVISIONS),
+        'after': '%040x' % rng.getrandbits(160),
+        'repository': {
+            'full_name': src['owner'] + '/' + src['repository'],
+        },
+        'head_commit': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+    })
+
+
+def recorded_payloads(pth):
+    """
+    Load recorded delivery bodies from a directory of JSON files or
+    a file with one JSON body per line.
+    """
+    if path.isdir(pth):
+        bodies = []
+        for name in sorted(os.listdir(pth)):
+            if name.endswith('.json'):
+                with open(path.join(pth, name), 'r') as fil:
+                    bodies.append(fil.read())
+        return bodies
+
+    with open(pth, 'r') as fil:
+        return [line.strip() for line in fil if line.strip()]
+
+
+def push_event(body, secret=SECRET):
+    """Return an API Gateway proxy event for a signed push delivery"""
+    mac = hmac.new(secret.encode(), msg=body.encode(), digestmod='sha1')
+    return {
+        'headers': {
+            'X-GitHub-Event': 'push',
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+            'X-Hub-Signature': 'sha1=' + mac.hexdigest(),
+        },
+        'body': body,
+    }
+
+
+def percentile(values, pct):
+    """Return the nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def setup_environment(conf):
+    """
+    Configure the webhook and create the S3 and CodeBuild stand-ins,
+    must run within moto mocks and a patched os.environ
+    """
+    os.environ.update({
+        'MULTIPLEXER_CONFIG_BUCKET': CONFIG_BUCKET,
+        'MULTIPLEXER_CONFIG_NAME': CONFIG_NAME,
+        'MULTIPLEXER_CODEBUILD_PROJECT': PROJECT_NAME,
+        'WEBHOOK_SECRET': SECRET,
+    })
+    # Only measure the CodeBuild path
+    for name in ('MULTIPLEXER_LAMBDA_MAX_SOURCES', 'MULTIPLEXER_PREFETCH',
+                 'MULTIPLEXER_TRACE_FORMAT'):
+        os.environ.pop(name, None)
+
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=CONFIG_BUCKET)
+    s3.put_object(Bucket=CONFIG_BUCKET, Key=CONFIG_NAME,
+                  Body=json.dumps(conf).encode('utf-8'))
+
+    boto3.client('codebuild').create_project(
+        name=PROJECT_NAME,
+        source={'type': 'S3', 'location': CONFIG_BUCKET + '/build.zip'},
+        artifacts={'type': 'NO_ARTIFACTS'},
+        environment={'type': 'LINUX_CONTAINER',
+                     'image': 'aws/codebuild/python:3.5.2',
+                     'computeType': 'BUILD_GENERAL1_SMALL'},
+        serviceRole='arn:aws:iam::123456789012:role/loadtest')
+
+
+def replay(events, rate=0, concurrency=10):
+    """
+    Send events to github_handler, at most rate per second if set,
+    and return the load summary.
+
+    Latency is measured from when each event was due to be sent, so
+    time spent waiting for a free worker is included.
+    """
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def _send(event, scheduled):
+        try:
+            status = webhook.github_handler(event, None)['statusCode']
+        except Exception as err:
+            status = type(err).__name__
+        latency = time.time() - scheduled
+        with lock:
+            latencies.append(latency)
+            statuses[status] += 1
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for idx, event in enumerate(events):
+            scheduled = time.time()
+            if rate:
+                scheduled = started + idx / float(rate)
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(_send, event, scheduled)
+    duration = time.time() - started
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items()
+                 if not (isinstance(status, int) and status < 400))
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('errors', errors),
+        ('statuses', OrderedDict((str(k), v) for k, v in sorted(
+            statuses.items(), key=lambda s: str(s[0])))),
+        ('concurrency', concurrency),
+        ('rate', rate or None),
+        ('duration', round(duration, 3)),
+        ('throughput', round(len(latencies) / duration, 2) if duration else None),
+        ('mean', round(sum(latencies) / len(latencies), 4) if latencies else None),
+        ('p50', percentile(latencies, 50)),
+        ('p95', percentile(latencies, 95)),
+        ('p99', percentile(latencies, 99)),
+        ('max', latencies[-1] if latencies else None),
+    ])
+
+
+def run(requests=1000, rate=0, concurrency=10, artifacts=2000, sources=200,
+        sources_per_artifact=5, payloads=None, seed=None):
+    """Set up the stand-ins, replay the deliveries and return the summary"""
+    rng = random.Random(seed)
+    conf = synthetic_config(artifacts, sources, sources_per_artifact, rng)
+
+    if payloads:
+        recorded = recorded_payloads(payloads)
+        bodies = [recorded[idx % len(recorded)] for idx in range(requests)]
+    else:
+        bodies = [synthetic_payload(conf, rng) for _ in range(requests)]
+    events = [push_event(body) for body in bodies]
+
+    # Environment changes are undone once the replay finishes
+    with mock.patch.dict(os.environ), mock_s3(), mock_codebuild():
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'loadtest')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'loadtest')
+        setup_environment(conf)
+        summary = replay(events, rate, concurrency)
+    summary['artifacts'] = artifacts
+    summary['sources'] = sources
+    return summary
+
+
+def main():
+    """Main entry point"""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Replay Github push deliveries against the webhook handler.')
+
+    parser.add_argument('--requests', '-n', type=int, default=1000,
+                        help='Number of deliveries to send.')
+    parser.add_argument('--rate', '-r', type=float, default=0,
+                        help='Deliveries per second, 0 sends as fast as possible.')
+    parser.add_argument('--concurrency', '-c', type=int, default=10,
+                        help='Number of deliveries handled at once.')
+    parser.add_argument('--artifacts', type=int, default=2000,
+                        help='Number of artifacts in the synthetic configuration.')
+    parser.add_argument('--sources', type=int, default=200,
+                        help='Number of sources in the synthetic configuration.')
+    parser.add_argument('--sources-per-artifact', dest='sources_per_artifact',
+                        type=int, default=5,
+                        help='Number of sources in each synthetic artifact.')
+    parser.add_argument('--payloads', '-p',
+                        help='''Directory of recorded delivery bodies (*.json) or a
+                                file with one body per line, replayed in order.
+                                Synthetic deliveries are used if not set.''')
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for synthetic configuration and deliveries.')
+    parser.add_argument('--format', '-f', choices=('text', 'json'),
+                        default='text', help='Summary output format.')
+
+    args = parser.parse_args()
+
+    summary = run(args.requests, args.rate, args.concurrency, args.artifacts,
+                  args.sources, args.sources_per_artifact, args.payloads,
+                  args.seed)
+
+    if args.format == 'json':
+        print(json.dumps(summary, indent=2))
+        return
+
+    for key, value in summary.items():
+        if key in ('mean', 'p50', 'p95', 'p99', 'max') and value is not None:
+            value = '{:.1f} ms'.format(value * 1000)
+        elif key == 'statuses':
+            value = ', '.join('{}: {}'.format(*s) for s in value.items())
+        print('{:<12} {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()